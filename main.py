@@ -1,56 +1,162 @@
+import asyncio
+import functools
 import logging
-import requests
 import hashlib
 import os
-import re
 import json
+import ssl
 import ipaddress
-import uuid
-from typing import Optional
+import itertools
+import time
+from typing import List, Optional
 
-from fastapi import FastAPI, Request, HTTPException, Header, APIRouter
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+import httpx
+import orjson
+
+from fastapi import FastAPI, Request, HTTPException, Header, APIRouter, Query
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 # --- Basic Setup & Logging ---
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s %(levelname)s %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+# Request IDs are only log correlation IDs: startup time + PID + counter is unique enough
+REQUEST_ID_PREFIX = f"{int(time.time()):x}-{os.getpid():x}-"
+REQUEST_COUNTER = itertools.count()
+
+# --- Batching Configuration ---
+# Events sharing a pixel, token and test code are coalesced into one CAPI call
+MAX_BATCH = int(os.getenv("MAX_BATCH", "50"))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", "20"))
+# Idle batch workers exit after BATCH_IDLE_MS; past MAX_BATCH_KEYS live keys, events are sent unbatched
+BATCH_IDLE_MS = float(os.getenv("BATCH_IDLE_MS", "30000"))
+MAX_BATCH_KEYS = int(os.getenv("MAX_BATCH_KEYS", "256"))
+# Batch requests to Meta in flight at once, across all keys (matches the keep-alive pool)
+MAX_INFLIGHT_BATCHES = int(os.getenv("MAX_INFLIGHT_BATCHES", "100"))
+
+# --- Hash Cache Configuration ---
+# Raw PII value -> digest, kept in memory; set HASH_CACHE_SIZE=0 to disable
+HASH_CACHE_SIZE = int(os.getenv("HASH_CACHE_SIZE", "131072"))
+
 # --- App Initialization & Documentation ---
 app = FastAPI(
     title="Meta CAPI Event Connector",
     description="A secure and easy-to-use proxy to send server-side events to the Meta Conversions API (CAPI). This service handles PII hashing, server-data extraction, and payload formatting.",
     version="1.0.0",
     docs_url="/",  # Show docs at root for demo
+    default_response_class=ORJSONResponse,
 )
 
 # --- Middleware ---
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"POST, GET, OPTIONS"),
+    (b"access-control-allow-headers", b"*"),
+]
+
+class MinimalCORSMiddleware:
+    """
+    Attach static CORS headers to every response and answer preflights directly.
+    A lighter stand-in for CORSMiddleware, which inspects origins per request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": CORS_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), *CORS_HEADERS]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(MinimalCORSMiddleware)
+
+# --- Shared HTTP Client ---
+@app.on_event("startup")
+async def startup_http_client():
+    """
+    Create one pooled HTTP/2 client for all outbound Meta CAPI calls.
+    Reusing connections avoids a TCP/TLS handshake per event.
+    """
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    )
+    app.state.batchers = {}
+    app.state.batch_tasks = set()
+    app.state.delivery_tasks = set()
+    app.state.batch_slots = asyncio.Semaphore(MAX_INFLIGHT_BATCHES)
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """Stop batch workers and deliveries (failing their events), then close the HTTP client."""
+    tasks = [*app.state.batch_tasks, *app.state.delivery_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await app.state.http.aclose()
+
+@app.on_event("startup")
+async def check_hash_backend():
+    """
+    Report which SHA-256 implementation PII hashing will use.
+    OpenSSL picks SHA-NI/AVX2 code paths at runtime on supporting CPUs;
+    Python's built-in fallback is portable scalar code.
+    """
+    if hashlib.sha256.__name__.startswith("openssl_"):
+        logger.info("PII hashing uses %s SHA-256 (hardware-accelerated when available)", ssl.OPENSSL_VERSION)
+    else:
+        logger.warning("hashlib is not backed by OpenSSL; PII hashing falls back to portable SHA-256")
 
 # --- API Router for Versioning ---
 router_v1 = APIRouter(prefix="/v1")
 
 # --- Pydantic Models ---
+class UserData(BaseModel):
+    # Raw PII (hashed before forwarding)
+    email: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    phone: Optional[str] = None
+    country: Optional[str] = None
+    city: Optional[str] = None
+    zip: Optional[str] = None
+    external_id: Optional[str] = None
+    # Browser signals (forwarded as-is); client_ip is only read for /process-events
+    client_ip: Optional[str] = None
+    user_agent: Optional[str] = None
+    fbc: Optional[str] = None
+    fbp: Optional[str] = None
+
+    model_config = ConfigDict(extra="ignore")
+
 class ClientPayload(BaseModel):
     event_name: str
     event_time: int
     event_source_url: Optional[str] = None
     action_source: str
-    user_data: dict  # Contains email, first_name, user_agent, etc.
+    user_data: UserData
     custom_data: Optional[dict] = None
     test_event_code: Optional[str] = None
 
-    class Config:
-        schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "event_name": "Purchase",
                 "event_time": 1703980800,
@@ -73,18 +179,66 @@ class ClientPayload(BaseModel):
                 }
             }
         }
+    )
+
+# Meta rejects requests with more than 1,000 events
+MAX_EVENTS_PER_REQUEST = 1000
+
+class BatchPayload(BaseModel):
+    events: List[ClientPayload] = Field(..., min_length=1, max_length=MAX_EVENTS_PER_REQUEST)
+    # Meta takes one test code per request, so it is set on the batch
+    test_event_code: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_event_test_codes(self):
+        for index, event in enumerate(self.events):
+            if event.test_event_code is not None and event.test_event_code != self.test_event_code:
+                raise ValueError(
+                    f"events[{index}].test_event_code must be omitted or match the batch test_event_code"
+                )
+        return self
 
 # --- Helper Functions ---
-FBP_REGEX = re.compile(r'^fb\.1\.\d+\.\d+$')
+# Meta user_data key -> client user_data key for every hashed PII field
+PII_FIELDS = (
+    ("em", "email"),
+    ("fn", "first_name"),
+    ("ln", "last_name"),
+    ("ph", "phone"),
+    ("country", "country"),
+    ("ct", "city"),
+    ("zp", "zip"),
+    ("external_id", "external_id"),
+)
+
+def is_valid_fbp(value: str) -> bool:
+    """
+    Check the _fbp cookie format (fb.1.<timestamp>.<random>).
+    Same check as the anchored fb.1.<digits>.<digits> pattern, without the regex engine.
+    """
+    parts = value.split(".")
+    return (
+        len(parts) == 4
+        and parts[0] == "fb"
+        and parts[1] == "1"
+        and parts[2].isdecimal()
+        and parts[3].isdecimal()
+    )
+
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def _hash_cached(value: str) -> str:
+    """
+    Normalize (strip + lowercase) and SHA-256 a PII value.
+    Keyed on the raw value so repeat customers skip normalization and hashing.
+    """
+    return hashlib.sha256(value.strip().lower().encode()).hexdigest()
 
 def hash_data(value: str) -> str:
     """
     Securely hash PII using SHA-256.
     Meta requires all PII to be hashed before transmission.
     """
-    if not value:
-        return ""
-    return hashlib.sha256(value.strip().lower().encode()).hexdigest()
+    return _hash_cached(value) if value else ""
 
 def extract_client_info(request: Request, payload: ClientPayload) -> dict:
     """
@@ -96,38 +250,60 @@ def extract_client_info(request: Request, payload: ClientPayload) -> dict:
     client_ip = x_forwarded_for.split(",")[0].strip() if x_forwarded_for else request.client.host
     
     # Prioritize User Agent from payload (original browser), fallback to request headers
-    client_user_agent = payload.user_data.get("user_agent") or request.headers.get("user-agent", "")
+    client_user_agent = payload.user_data.user_agent or request.headers.get("user-agent", "")
     
     return {
         "ip": client_ip,
         "user_agent": client_user_agent
     }
 
-def validate_and_clean_data(payload: ClientPayload, client_info: dict, request_id: str) -> dict:
+def event_client_info(payload: ClientPayload) -> dict:
     """
-    Validate and clean all incoming data before sending to Meta.
-    Ensures data integrity and prevents API errors.
+    Client IP and User Agent taken only from the event itself.
+    Used for batches, where the request's own IP and headers belong to the
+    sending server rather than to each event's user.
     """
-    # Validate IP address
-    client_ip = client_info["ip"]
-    try:
-        if client_ip:
+    return {
+        "ip": payload.user_data.client_ip or "",
+        "user_agent": payload.user_data.user_agent or ""
+    }
+
+def is_ipv4(value: str) -> bool:
+    """
+    Check for a dotted-quad IPv4 address without building an ipaddress object.
+    Mirrors ipaddress's rules: ASCII digits only, 0-255, no leading zeros.
+    """
+    parts = value.split(".")
+    return len(parts) == 4 and value.isascii() and all(
+        p.isdigit() and len(p) <= 3 and (p == "0" or p[0] != "0") and int(p) < 256
+        for p in parts
+    )
+
+def clean_client_ip(client_ip: str, request_id: str) -> str:
+    """
+    Return the client IP if it parses as an IPv4/IPv6 address, else "".
+    """
+    if not client_ip or is_ipv4(client_ip):
+        return client_ip
+
+    # Only IPv6 candidates need the full parser
+    if ":" in client_ip:
+        try:
             ipaddress.ip_address(client_ip)
-    except ValueError:
-        logger.warning(f"[{request_id}] Invalid IP address: {client_ip}. Removing from payload.")
-        client_ip = ""
-
-    # Validate Facebook Pixel browser ID format
-    fbp_val = payload.user_data.get("fbp", "")
-    if fbp_val and not FBP_REGEX.match(fbp_val):
-        logger.warning(f"[{request_id}] Invalid _fbp format: {fbp_val}. Removing from payload.")
-        fbp_val = ""
-
-    # Clean and validate custom_data
-    custom_data = payload.custom_data or {}
+            return client_ip
+        except ValueError:
+            pass
+
+    logger.warning("[%s] Invalid IP address: %s. Removing from payload.", request_id, client_ip)
+    return ""
+
+def clean_custom_data(custom_data: Optional[dict], request_id: str) -> dict:
+    """
+    Drop null values from custom_data and validate the value/currency pair.
+    """
     cleaned_custom_data = {
-        k: v for k, v in custom_data.items() 
-        if v is not None and str(v).lower() != 'null'
+        k: v for k, v in (custom_data or {}).items() 
+        if v is not None and not (isinstance(v, str) and v.lower() == 'null')
     }
     
     # Validate currency + value relationship
@@ -135,7 +311,7 @@ def validate_and_clean_data(payload: ClientPayload, client_info: dict, request_i
         try:
             cleaned_custom_data['value'] = float(cleaned_custom_data['value'])
         except (ValueError, TypeError):
-            logger.warning(f"[{request_id}] Invalid 'value' in custom_data. Setting to 0.0.")
+            logger.warning("[%s] Invalid 'value' in custom_data. Setting to 0.0.", request_id)
             cleaned_custom_data['value'] = 0.0
             
         if not cleaned_custom_data.get('currency'):
@@ -147,76 +323,312 @@ def validate_and_clean_data(payload: ClientPayload, client_info: dict, request_i
                 }
             )
 
-    return {
-        "client_ip": client_ip,
-        "client_user_agent": client_info["user_agent"],
-        "fbp": fbp_val,
-        "fbc": payload.user_data.get("fbc", ""),
-        "custom_data": cleaned_custom_data
-    }
+    return cleaned_custom_data
 
-def hash_user_data(user_data: dict, request_id: str) -> dict:
+def transform(payload: ClientPayload, client_info: dict, request_id: str) -> dict:
     """
-    Hash all PII according to Meta's requirements.
-    Returns only non-empty hashed values.
+    Validate, hash and format a single Meta event in one pass over user_data.
+    Writes straight into the output dict, so no intermediate dicts are built.
     """
-    pii_fields = {
-        "em": user_data.get("email", ""),
-        "fn": user_data.get("first_name", ""),
-        "ln": user_data.get("last_name", ""),
-        "ph": user_data.get("phone", ""),
-        "country": user_data.get("country", ""),
-        "ct": user_data.get("city", ""),
-        "zp": user_data.get("zip", ""),
-        "external_id": user_data.get("external_id", "")
-    }
-    
-    # Hash and filter out empty values
-    hashed_pii = {k: hash_data(v) for k, v in pii_fields.items() if v}
-    
-    # Log summary (for debugging/monitoring)
-    pii_summary = ", ".join([f"{k}:present" for k in hashed_pii.keys()])
-    logger.info(f"[{request_id}] PII processed: {pii_summary}")
-    
-    return hashed_pii
+    user_data = payload.user_data
+    out = {}
+
+    # Server-side signals
+    if client_ip := clean_client_ip(client_info["ip"], request_id):
+        out["client_ip_address"] = client_ip
+    if client_info["user_agent"]:
+        out["client_user_agent"] = client_info["user_agent"]
+    if fbc := user_data.fbc:
+        out["fbc"] = fbc
+    if fbp := user_data.fbp:
+        if is_valid_fbp(fbp):
+            out["fbp"] = fbp
+        else:
+            logger.warning("[%s] Invalid _fbp format: %s. Removing from payload.", request_id, fbp)
+
+    # Hash PII straight into the output
+    for dst, src in PII_FIELDS:
+        if v := getattr(user_data, src):
+            out[dst] = hash_data(v)
+
+    if logger.isEnabledFor(logging.INFO):
+        pii_summary = ", ".join([f"{dst}:present" for dst, _ in PII_FIELDS if dst in out])
+        logger.info("[%s] PII processed: %s", request_id, pii_summary)
 
-def build_meta_payload(payload: ClientPayload, validated_data: dict, hashed_pii: dict) -> dict:
-    """
-    Build the final payload in Meta's required format.
-    """
-    # Construct user_data object
-    user_data = {
-        "client_ip_address": validated_data["client_ip"] or None,
-        "client_user_agent": validated_data["client_user_agent"] or None,
-        "fbc": validated_data["fbc"] or None,
-        "fbp": validated_data["fbp"] or None,
-    }
-    
-    # Add hashed PII
-    user_data.update(hashed_pii)
-    
-    # Remove None values for cleaner payload
-    user_data = {k: v for k, v in user_data.items() if v is not None}
-    
-    # Build event data
     event_data = {
         "event_name": payload.event_name,
         "event_time": payload.event_time,
         "action_source": payload.action_source,
-        "user_data": user_data,
-        "custom_data": validated_data["custom_data"]
+        "user_data": out,
+        "custom_data": clean_custom_data(payload.custom_data, request_id)
     }
     
     if payload.event_source_url:
         event_data["event_source_url"] = payload.event_source_url
-    
-    # Final Meta payload
-    meta_payload = {"data": [event_data]}
-    
-    if payload.test_event_code:
-        meta_payload["test_event_code"] = payload.test_event_code
-        
-    return meta_payload
+
+    return event_data
+
+def encode_json(value: dict) -> bytes:
+    """
+    JSON-encode part of an outbound Meta request.
+    orjson handles the common case; stdlib json covers what orjson rejects,
+    such as integers beyond 64 bits or lone surrogates (escaped as \\uXXXX),
+    so anything that passed validation still encodes.
+    """
+    try:
+        return orjson.dumps(value)
+    except orjson.JSONEncodeError:
+        return json.dumps(value, separators=(",", ":")).encode()
+
+# --- Errors ---
+# Meta error bodies are truncated so a misbehaving upstream can't bloat logs/responses
+MAX_ERROR_BODY = 1024
+
+class MetaAPIError(Exception):
+    """Meta CAPI answered with an HTTP error status or an unreadable body."""
+
+    def __init__(self, status_code: int, body: str, message: Optional[str] = None):
+        super().__init__(message or f"Meta CAPI returned HTTP {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+class BatcherClosedError(Exception):
+    """The batch worker stopped (normally at shutdown) before a queued event was sent."""
+
+def meta_failure(request_id: str, e: Exception) -> HTTPException:
+    """
+    Log a failed Meta CAPI call and build the 502 returned to the client.
+    """
+    detail = {
+        "request_id": request_id,
+        "message": "Failed to send event to Meta CAPI",
+        "error": str(e)
+    }
+    if isinstance(e, MetaAPIError):
+        logger.error("[%s] Meta CAPI request failed: %s | Response: %s", request_id, e, e.body)
+        detail["meta_status"] = e.status_code
+        detail["meta_body"] = e.body
+    else:
+        logger.error("[%s] Meta CAPI request failed: %s", request_id, e)
+    return HTTPException(status_code=502, detail=detail)
+
+# --- Event Batching ---
+@functools.lru_cache(maxsize=256)
+def capi_url(pixel_id: str) -> str:
+    """Meta CAPI events endpoint for a pixel."""
+    return f"https://graph.facebook.com/v19.0/{pixel_id}/events"
+
+def encode_envelope_tail(access_token: str, test_event_code: Optional[str]) -> bytes:
+    """
+    Pre-encode everything that follows the event list in a CAPI request body.
+    The token travels in the body so the URL stays constant per pixel.
+    """
+    envelope = {"access_token": access_token}
+    if test_event_code:
+        envelope["test_event_code"] = test_event_code
+    return b"]," + encode_json(envelope)[1:]
+
+async def send_events(app: FastAPI, pixel_id: str, events: list, envelope_tail: bytes) -> dict:
+    """
+    POST pre-encoded events to Meta CAPI in one request and return the parsed response.
+    Raises MetaAPIError on an HTTP error status or non-JSON body, and
+    httpx.HTTPError on transport failures.
+    """
+    response = await app.state.http.post(
+        capi_url(pixel_id),
+        content=b'{"data":[' + b",".join(events) + envelope_tail,
+        headers={"content-type": "application/json"},
+    )
+    if response.status_code >= 400:
+        raise MetaAPIError(
+            response.status_code,
+            response.content[:MAX_ERROR_BODY].decode(errors="replace"),
+        )
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise MetaAPIError(
+            response.status_code,
+            response.content[:MAX_ERROR_BODY].decode(errors="replace"),
+            "Meta CAPI returned a non-JSON response",
+        )
+
+async def run_batch_worker(
+    app: FastAPI,
+    queue: asyncio.Queue,
+    pixel_id: str,
+    access_token: str,
+    test_event_code: Optional[str],
+):
+    """
+    Drain queued events into a single Meta CAPI request.
+    Waits up to MAX_WAIT_MS after the first event, or until MAX_BATCH events
+    are collected, then starts a delivery task for the batch and goes straight
+    back to collecting, so several batches per key can be in flight (bounded by
+    MAX_INFLIGHT_BATCHES across all keys). Exits and releases
+    its key after BATCH_IDLE_MS without events. If it stops any other way
+    (cancellation or an unexpected error), it releases its key and fails every
+    event it still holds so no request waits forever.
+    """
+    key = (pixel_id, access_token, test_event_code)
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        # Everything after the event list is fixed per worker, so encode it once
+        envelope_tail = encode_envelope_tail(access_token, test_event_code)
+
+        while True:
+            try:
+                batch = [await asyncio.wait_for(queue.get(), timeout=BATCH_IDLE_MS / 1000)]
+            except asyncio.TimeoutError:
+                # No await between the check and the removal, so no event can slip in
+                if queue.empty():
+                    release_batcher(app, key, queue)
+                    return
+                continue
+
+            deadline = loop.time() + MAX_WAIT_MS / 1000
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await app.state.batch_slots.acquire()
+            start_delivery(app, pixel_id, batch, envelope_tail)
+            batch = []
+    except asyncio.CancelledError:
+        close_batcher(app, key, queue, batch, BatcherClosedError("Service is shutting down"))
+        raise
+    except Exception:
+        logger.exception("Batch worker for Pixel %s stopped unexpectedly", pixel_id)
+        close_batcher(app, key, queue, batch, BatcherClosedError("Batch worker stopped unexpectedly"))
+
+def release_batcher(app: FastAPI, key: tuple, queue: asyncio.Queue):
+    """Forget a worker's queue so the next event for its key starts a fresh one."""
+    if app.state.batchers.get(key) is queue:
+        del app.state.batchers[key]
+
+def close_batcher(app: FastAPI, key: tuple, queue: asyncio.Queue, batch: list, error: Exception):
+    """Release a stopping worker's key and fail the events it holds or has queued."""
+    release_batcher(app, key, queue)
+    fail_futures(batch, error)
+    while not queue.empty():
+        fail_futures([queue.get_nowait()], error)
+
+def start_delivery(app: FastAPI, pixel_id: str, batch: list, envelope_tail: bytes):
+    """
+    Run deliver_batch as a tracked task holding one of the acquired batch slots.
+    The task is tracked so shutdown can cancel it and fail its events.
+    """
+    task = asyncio.create_task(run_delivery(app, pixel_id, batch, envelope_tail))
+    app.state.delivery_tasks.add(task)
+    task.add_done_callback(app.state.delivery_tasks.discard)
+
+async def run_delivery(app: FastAPI, pixel_id: str, batch: list, envelope_tail: bytes):
+    """Deliver one batch, then free its slot; events still pending on cancellation fail."""
+    try:
+        await deliver_batch(app, pixel_id, batch, envelope_tail)
+    except asyncio.CancelledError:
+        fail_futures(batch, BatcherClosedError("Service is shutting down"))
+        raise
+    finally:
+        app.state.batch_slots.release()
+
+async def deliver_batch(app: FastAPI, pixel_id: str, batch: list, envelope_tail: bytes):
+    """
+    Send a batch of (encoded event, future) pairs and resolve each future.
+    Meta rejects a whole request when any event in it is invalid, so a 4xx on
+    a multi-event batch is bisected (halves sent concurrently) until only the
+    offending events fail. Errors that apply to every event, such as a bad
+    token, fail the batch at once. Each caller gets Meta's response with
+    events_received counting its own event.
+    """
+    try:
+        meta_response = await send_events(
+            app, pixel_id, [event for event, _ in batch], envelope_tail
+        )
+    except MetaAPIError as e:
+        if len(batch) > 1 and 400 <= e.status_code < 500 and not is_batch_wide_error(e):
+            mid = len(batch) // 2
+            await asyncio.gather(
+                deliver_batch(app, pixel_id, batch[:mid], envelope_tail),
+                deliver_batch(app, pixel_id, batch[mid:], envelope_tail),
+            )
+            return
+        fail_futures(batch, e)
+    except Exception as e:
+        fail_futures(batch, e)
+    else:
+        if len(batch) > 1:
+            meta_response = {**meta_response, "events_received": 1}
+        for _, future in batch:
+            if not future.done():
+                future.set_result(meta_response)
+
+def is_batch_wide_error(e: MetaAPIError) -> bool:
+    """
+    Whether a Meta error applies to the whole request rather than to one event.
+    Splitting such a batch would only repeat the same failure per half.
+    """
+    # Rate limits, authentication and permission failures
+    if e.status_code in (401, 403, 429):
+        return True
+    try:
+        error = orjson.loads(e.body).get("error")
+    except (orjson.JSONDecodeError, AttributeError):
+        return False
+    if not isinstance(error, dict):
+        return False
+    code = error.get("code")
+    # 190/102: invalid or expired token; 10 and 200-299: permission errors
+    if code in (190, 102, 10) or (isinstance(code, int) and 200 <= code < 300):
+        return True
+    # The Graph API labels most errors OAuthException; code 100 (invalid
+    # parameter) is the one that points at a specific bad event
+    return error.get("type") == "OAuthException" and code != 100
+
+def fail_futures(batch: list, e: Exception):
+    """Fail every still-pending future in a batch with the same error."""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(e)
+
+async def submit_event(
+    app: FastAPI, pixel_id: str, access_token: str, test_event_code: Optional[str], event: bytes
+) -> dict:
+    """
+    Queue a single encoded event for batched delivery and wait for Meta's response.
+    One queue and worker task is created lazily per (pixel, token, test code).
+    All three come from the client, so once MAX_BATCH_KEYS keys are live,
+    events for new keys are sent on their own instead.
+    """
+    key = (pixel_id, access_token, test_event_code)
+    queue = app.state.batchers.get(key)
+    if queue is None:
+        if len(app.state.batchers) >= MAX_BATCH_KEYS:
+            return await send_events(
+                app, pixel_id, [event], encode_envelope_tail(access_token, test_event_code)
+            )
+        queue = app.state.batchers[key] = asyncio.Queue()
+        task = asyncio.create_task(
+            run_batch_worker(app, queue, pixel_id, access_token, test_event_code)
+        )
+        app.state.batch_tasks.add(task)
+        task.add_done_callback(app.state.batch_tasks.discard)
+
+    future = asyncio.get_running_loop().create_future()
+    # put_nowait: no await between looking up the queue and enqueueing on it
+    queue.put_nowait((event, future))
+    return await future
 
 # --- API Endpoints ---
 @app.get("/health", tags=["Health"])
@@ -224,12 +636,26 @@ def health_check():
     """Simple health check endpoint."""
     return {"status": "healthy", "service": "Meta CAPI Event Connector"}
 
+@app.get("/metrics", tags=["Health"])
+def metrics():
+    """PII hash cache statistics."""
+    info = _hash_cached.cache_info()
+    return {
+        "hash_cache": {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+        }
+    }
+
 @router_v1.post("/process-event", tags=["Events"])
-def process_event(
+async def process_event(
     payload: ClientPayload,
     request: Request,
     x_meta_pixel_id: str = Header(..., description="Your Meta Pixel ID"),
-    x_meta_access_token: str = Header(..., description="Your Meta CAPI Access Token")
+    x_meta_access_token: str = Header(..., description="Your Meta CAPI Access Token"),
+    verbose: bool = Query(True, description="Include Meta's response body in the result")
 ):
     """
     Process and forward a server-side event to Meta's Conversions API.
@@ -239,58 +665,126 @@ def process_event(
     2. Validates and cleans all data
     3. Securely hashes PII
     4. Formats payload for Meta CAPI
-    5. Forwards to Meta and returns response
+    5. Forwards to Meta (batched with concurrent events) and returns response
     """
-    request_id = str(uuid.uuid4())
-    logger.info(f"[{request_id}] Processing {payload.event_name} event for Pixel {x_meta_pixel_id}")
+    request_id = f"{REQUEST_ID_PREFIX}{next(REQUEST_COUNTER):x}"
+    logger.info("[%s] Processing %s event for Pixel %s", request_id, payload.event_name, x_meta_pixel_id)
     
     try:
         # Step 1: Extract client information
         client_info = extract_client_info(request, payload)
         
-        # Step 2: Validate and clean data
-        validated_data = validate_and_clean_data(payload, client_info, request_id)
-        
-        # Step 3: Hash PII
-        hashed_pii = hash_user_data(payload.user_data, request_id)
-        
-        # Step 4: Build Meta payload
-        meta_payload = build_meta_payload(payload, validated_data, hashed_pii)
-        
-        # Step 5: Send to Meta CAPI
-        capi_url = f"https://graph.facebook.com/v19.0/{x_meta_pixel_id}/events?access_token={x_meta_access_token}"
+        # Steps 2-4: Validate, hash PII and build the Meta event in one pass
+        event = transform(payload, client_info, request_id)
         
-        response = requests.post(capi_url, json=meta_payload, timeout=10)
-        response.raise_for_status()
+        # Step 5: Send to Meta CAPI (batched with concurrent events for the same pixel)
+        meta_response = await submit_event(
+            request.app,
+            x_meta_pixel_id,
+            x_meta_access_token,
+            payload.test_event_code,
+            encode_json(event),
+        )
         
-        logger.info(f"[{request_id}] Successfully sent event to Meta CAPI")
+        logger.info("[%s] Successfully sent event to Meta CAPI", request_id)
         
-        return {
+        result = {
             "request_id": request_id,
             "status": "success",
             "message": "Event processed and sent to Meta CAPI successfully",
-            "meta_response": response.json()
         }
+        if verbose:
+            result["meta_response"] = meta_response
+        return result
         
-    except requests.exceptions.RequestException as e:
-        error_detail = f"Meta CAPI request failed: {str(e)}"
-        if hasattr(e, 'response') and e.response:
-            error_detail += f" | Response: {e.response.text}"
-            
-        logger.error(f"[{request_id}] {error_detail}")
+    except (MetaAPIError, httpx.HTTPError) as e:
+        raise meta_failure(request_id, e)
         
+    except BatcherClosedError as e:
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "request_id": request_id,
+                "message": f"{e}; event was not sent to Meta CAPI"
+            }
+        )
+
+@router_v1.post("/process-events", tags=["Events"])
+async def process_events(
+    payload: BatchPayload,
+    request: Request,
+    x_meta_pixel_id: str = Header(..., description="Your Meta Pixel ID"),
+    x_meta_access_token: str = Header(..., description="Your Meta CAPI Access Token"),
+    verbose: bool = Query(True, description="Include Meta's response body in the result")
+):
+    """
+    Process up to 1,000 events and forward them to Meta in a single CAPI request.
+    
+    Each event goes through the same validation and hashing as /process-event.
+    Client IP and User Agent come only from each event's user_data, never from
+    this request. Per-event test_event_code must be omitted or match the
+    batch's. Events that fail validation are reported in the per-event status list and
+    left out of the request; the rest are sent together. Keep request bodies
+    under 1 MB.
+    """
+    request_id = f"{REQUEST_ID_PREFIX}{next(REQUEST_COUNTER):x}"
+    logger.info("[%s] Processing batch of %d events for Pixel %s", request_id, len(payload.events), x_meta_pixel_id)
+    
+    encoded_events = []
+    statuses = []
+    for index, event_payload in enumerate(payload.events):
+        try:
+            event = transform(event_payload, event_client_info(event_payload), request_id)
+        except HTTPException as e:
+            statuses.append({"index": index, "status": "error", "message": e.detail["message"]})
+            continue
+        encoded_events.append(encode_json(event))
+        statuses.append({"index": index, "status": "success"})
+    
+    if not encoded_events:
         raise HTTPException(
-            status_code=502,
+            status_code=422,
             detail={
                 "request_id": request_id,
-                "message": "Failed to send event to Meta CAPI",
-                "error": str(e)
+                "message": "No valid events in batch.",
+                "events": statuses
             }
         )
+    
+    try:
+        meta_response = await send_events(
+            request.app,
+            x_meta_pixel_id,
+            encoded_events,
+            encode_envelope_tail(x_meta_access_token, payload.test_event_code),
+        )
+    except (MetaAPIError, httpx.HTTPError) as e:
+        raise meta_failure(request_id, e)
+    
+    logger.info("[%s] Successfully sent %d events to Meta CAPI", request_id, len(encoded_events))
+    
+    result = {
+        "request_id": request_id,
+        "status": "success" if len(encoded_events) == len(statuses) else "partial",
+        "message": f"{len(encoded_events)} of {len(statuses)} events sent to Meta CAPI",
+        "events": statuses,
+    }
+    if verbose:
+        result["meta_response"] = meta_response
+    return result
 
 # Include the versioned router
 app.include_router(router_v1)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" picks uvloop + httptools when installed (see requirements.txt)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WORKERS", os.cpu_count() or 1)),
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+    )
\ No newline at end of file
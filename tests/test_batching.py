@@ -0,0 +1,326 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def make_client(handler):
+    """Shared AsyncClient whose requests are answered by handler instead of Meta."""
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def meta_ok(request):
+    body = json.loads(request.content)
+    return httpx.Response(200, json={"events_received": len(body["data"]), "fbtrace_id": "trace"})
+
+
+async def use_mock(handler):
+    """Swap the app's real HTTP client for a mock, closing the real one first."""
+    await main.app.state.http.aclose()
+    main.app.state.http = make_client(handler)
+
+
+async def start(handler):
+    await main.startup_http_client()
+    await use_mock(handler)
+
+
+def test_concurrent_events_share_one_request():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return meta_ok(request)
+
+    async def run():
+        await start(handler)
+        results = await asyncio.gather(
+            *[main.submit_event(main.app, "1", "token", None, main.encode_json({"n": i})) for i in range(5)]
+        )
+        await main.shutdown_http_client()
+        return results
+
+    results = asyncio.run(run())
+    assert len(requests_seen) == 1
+    assert requests_seen[0]["data"] == [{"n": i} for i in range(5)]
+    assert requests_seen[0]["access_token"] == "token"
+    assert all(r["events_received"] == 1 for r in results)
+
+
+def test_rejected_event_does_not_fail_its_batch():
+    def handler(request):
+        if any(e.get("bad") for e in json.loads(request.content)["data"]):
+            return httpx.Response(
+                400, json={"error": {"message": "Invalid parameter", "type": "OAuthException", "code": 100}}
+            )
+        return meta_ok(request)
+
+    async def run():
+        await start(handler)
+        events = [{"n": i, "bad": i == 3} for i in range(8)]
+        results = await asyncio.gather(
+            *[main.submit_event(main.app, "1", "token", None, main.encode_json(e)) for e in events],
+            return_exceptions=True,
+        )
+        await main.shutdown_http_client()
+        return results
+
+    results = asyncio.run(run())
+    assert isinstance(results[3], main.MetaAPIError)
+    assert results[3].status_code == 400
+    assert all(r["events_received"] == 1 for i, r in enumerate(results) if i != 3)
+
+
+def test_batches_for_one_key_are_sent_concurrently(monkeypatch):
+    monkeypatch.setattr(main, "MAX_BATCH", 10)
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return meta_ok(request)
+
+    async def run():
+        await start(handler)
+        results = await asyncio.gather(
+            *[main.submit_event(main.app, "1", "token", None, main.encode_json({"n": i})) for i in range(100)]
+        )
+        await main.shutdown_http_client()
+        return results
+
+    results = asyncio.run(run())
+    assert len(results) == 100
+    assert peak == 10
+
+
+def test_bad_token_fails_the_batch_without_splitting():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return httpx.Response(
+            400,
+            json={"error": {"message": "Invalid OAuth access token.", "type": "OAuthException", "code": 190}},
+        )
+
+    async def run():
+        await start(handler)
+        results = await asyncio.gather(
+            *[main.submit_event(main.app, "1", "bad", None, main.encode_json({"n": i})) for i in range(8)],
+            return_exceptions=True,
+        )
+        await main.shutdown_http_client()
+        return results
+
+    results = asyncio.run(run())
+    assert len(requests_seen) == 1
+    assert all(isinstance(r, main.MetaAPIError) and r.status_code == 400 for r in results)
+
+
+def test_idle_worker_exits_and_releases_its_key(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_IDLE_MS", 10)
+
+    async def run():
+        await start(meta_ok)
+        await main.submit_event(main.app, "1", "token", "TEST1", main.encode_json({"n": 1}))
+        assert ("1", "token", "TEST1") in main.app.state.batchers
+        await asyncio.sleep(0.1)
+        state = (dict(main.app.state.batchers), set(main.app.state.batch_tasks))
+        await main.shutdown_http_client()
+        return state
+
+    batchers, tasks = asyncio.run(run())
+    assert batchers == {}
+    assert tasks == set()
+
+
+def test_new_keys_bypass_batching_past_the_cap(monkeypatch):
+    monkeypatch.setattr(main, "MAX_BATCH_KEYS", 2)
+
+    async def run():
+        await start(meta_ok)
+        results = await asyncio.gather(
+            *[main.submit_event(main.app, "1", "token", f"TEST{i}", main.encode_json({"n": i})) for i in range(5)]
+        )
+        live_keys = len(main.app.state.batchers)
+        await main.shutdown_http_client()
+        return results, live_keys
+
+    results, live_keys = asyncio.run(run())
+    assert live_keys == 2
+    assert all(r["events_received"] == 1 for r in results)
+
+
+def test_shutdown_fails_queued_events(monkeypatch):
+    monkeypatch.setattr(main, "MAX_WAIT_MS", 10_000)
+
+    async def run():
+        await start(meta_ok)
+        pending = asyncio.ensure_future(main.submit_event(main.app, "1", "token", None, main.encode_json({"n": 1})))
+        await asyncio.sleep(0.01)
+        await main.shutdown_http_client()
+        return await asyncio.wait_for(pending, timeout=1)
+
+    with pytest.raises(main.BatcherClosedError):
+        asyncio.run(run())
+
+
+def test_shutdown_fails_in_flight_deliveries():
+    async def slow(request):
+        await asyncio.sleep(10)
+        return meta_ok(request)
+
+    async def run():
+        await start(slow)
+        pending = asyncio.ensure_future(
+            main.submit_event(main.app, "1", "token", None, main.encode_json({"n": 1}))
+        )
+        await asyncio.sleep(0.1)
+        assert main.app.state.delivery_tasks
+        await main.shutdown_http_client()
+        return await asyncio.wait_for(pending, timeout=1)
+
+    with pytest.raises(main.BatcherClosedError):
+        asyncio.run(run())
+
+
+def test_event_with_big_integer_is_encoded():
+    assert json.loads(main.encode_json({"custom_data": {"big": 2**70}})) == {"custom_data": {"big": 2**70}}
+
+
+def test_non_json_success_body_is_a_meta_error():
+    async def run():
+        await start(lambda request: httpx.Response(200, text="<html>maintenance</html>"))
+        try:
+            return await asyncio.gather(
+                main.submit_event(main.app, "1", "token", None, main.encode_json({"n": 1})),
+                return_exceptions=True,
+            )
+        finally:
+            await main.shutdown_http_client()
+
+    (error,) = asyncio.run(run())
+    assert isinstance(error, main.MetaAPIError)
+    assert error.status_code == 200
+    assert error.body == "<html>maintenance</html>"
+
+
+def test_lone_surrogate_test_code_is_sent():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return meta_ok(request)
+
+    async def run():
+        await start(handler)
+        result = await asyncio.wait_for(
+            main.submit_event(main.app, "1", "token", "\ud800", main.encode_json({"n": 1})), timeout=1
+        )
+        await main.shutdown_http_client()
+        return result
+
+    assert asyncio.run(run())["events_received"] == 1
+    assert requests_seen[0]["test_event_code"] == "\ud800"
+
+
+def test_crashed_worker_fails_its_events_and_releases_its_key(monkeypatch):
+    def broken_tail(access_token, test_event_code):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "encode_envelope_tail", broken_tail)
+
+    async def run():
+        await start(meta_ok)
+        try:
+            await asyncio.wait_for(
+                main.submit_event(main.app, "1", "token", None, main.encode_json({"n": 1})), timeout=1
+            )
+        finally:
+            batchers = dict(main.app.state.batchers)
+            await main.shutdown_http_client()
+        return batchers
+
+    with pytest.raises(main.BatcherClosedError):
+        asyncio.run(run())
+    assert main.app.state.batchers == {}
+
+
+EVENT = {
+    "event_name": "Purchase",
+    "event_time": 1703980800,
+    "action_source": "website",
+    "user_data": {"email": "customer@example.com"},
+}
+HEADERS = {"x-meta-pixel-id": "1", "x-meta-access-token": "token", "x-forwarded-for": "1.2.3.4"}
+
+
+def post_batch(body):
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return meta_ok(request)
+
+    with TestClient(main.app) as client:
+        client.portal.call(use_mock, handler)
+        # json.dumps escapes lone surrogates, which httpx's own json= encoder rejects
+        response = client.post(
+            "/v1/process-events",
+            content=json.dumps(body),
+            headers={**HEADERS, "content-type": "application/json"},
+        )
+    return response, requests_seen
+
+
+def test_batch_rejects_mismatched_event_test_code():
+    response, requests_seen = post_batch({"events": [{**EVENT, "test_event_code": "TEST1"}]})
+    assert response.status_code == 422
+    assert requests_seen == []
+
+
+def test_batch_accepts_matching_event_test_code():
+    response, requests_seen = post_batch(
+        {"events": [{**EVENT, "test_event_code": "TEST1"}], "test_event_code": "TEST1"}
+    )
+    assert response.status_code == 200
+    assert requests_seen[0]["test_event_code"] == "TEST1"
+
+
+def test_batch_events_use_only_their_own_client_ip():
+    with_ip = {**EVENT, "user_data": {**EVENT["user_data"], "client_ip": "5.6.7.8"}}
+    response, requests_seen = post_batch({"events": [with_ip, EVENT]})
+    assert response.status_code == 200
+    sent = [event["user_data"] for event in requests_seen[0]["data"]]
+    assert sent[0]["client_ip_address"] == "5.6.7.8"
+    assert "client_ip_address" not in sent[1]
+    assert "client_user_agent" not in sent[1]
+
+
+def test_batch_with_lone_surrogate_test_code_is_sent():
+    response, requests_seen = post_batch({"events": [EVENT], "test_event_code": "\ud800"})
+    assert response.status_code == 200
+    assert requests_seen[0]["test_event_code"] == "\ud800"
+
+
+def test_single_event_ignores_payload_client_ip():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return meta_ok(request)
+
+    with_ip = {**EVENT, "user_data": {**EVENT["user_data"], "client_ip": "5.6.7.8"}}
+    with TestClient(main.app) as client:
+        client.portal.call(use_mock, handler)
+        response = client.post("/v1/process-event", json=with_ip, headers=HEADERS)
+    assert response.status_code == 200
+    assert requests_seen[0]["data"][0]["user_data"]["client_ip_address"] == "1.2.3.4"